@@ -1,140 +1,476 @@
 import argparse
+import errno
+import heapq
+import itertools
 import logging
 import mimetypes
 import multiprocessing
 import os
+import queue
+import re
+import selectors
 import socket
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
-from http import HTTPStatus
-from typing import Optional, Tuple
-from urllib.parse import unquote, urlparse
-
-OK = HTTPStatus.OK.numerator
-FORBIDDEN = HTTPStatus.FORBIDDEN.numerator
-NOT_FOUND = HTTPStatus.NOT_FOUND.numerator
-NOT_ALLOWED = HTTPStatus.METHOD_NOT_ALLOWED.numerator
-
-CODES_MAPPING = {
-    OK: HTTPStatus.OK.phrase,
-    FORBIDDEN: HTTPStatus.FORBIDDEN.phrase,
-    NOT_FOUND: HTTPStatus.NOT_FOUND.phrase,
-    NOT_ALLOWED: HTTPStatus.METHOD_NOT_ALLOWED.phrase,
+import stat
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote_to_bytes
+
+OK = 200
+FORBIDDEN = 403
+NOT_FOUND = 404
+NOT_ALLOWED = 405
+HEAD_TOO_LARGE = 431
+UNAVAILABLE = 503
+
+STATUS_LINES = {
+    OK: b"HTTP/1.1 200 OK\r\n",
+    FORBIDDEN: b"HTTP/1.1 403 Forbidden\r\n",
+    NOT_FOUND: b"HTTP/1.1 404 Not Found\r\n",
+    NOT_ALLOWED: b"HTTP/1.1 405 Method Not Allowed\r\n",
+    HEAD_TOO_LARGE: b"HTTP/1.1 431 Request Header Fields Too Large\r\n",
+    UNAVAILABLE: b"HTTP/1.1 503 Service Unavailable\r\n",
+}
+COMMON_HEADERS = b"Server: CustomWebServer\r\n"
+KEEP_ALIVE_HEADER = b"Connection: keep-alive\r\n"
+CLOSE_HEADER = b"Connection: close\r\n"
+CONNECTION_HEADER_RE = re.compile(rb"\r\nconnection:[ \t]*([^\r]*)", re.IGNORECASE)
+BODY_HEADER_RE = re.compile(
+    rb"\r\n(?:content-length|transfer-encoding):", re.IGNORECASE
+)
+OK_HEADERS = STATUS_LINES[OK] + COMMON_HEADERS
+# error responses carry no body, only the Date header varies between them
+ERROR_HEADERS = {
+    code: status_line
+    + COMMON_HEADERS
+    + b"Content-Type: text/html\r\nContent-Length: 0\r\n"
+    for code, status_line in STATUS_LINES.items()
+    if code != OK
 }
 
+# the socket module only exports it from Python 3.11, the Linux value is 49
+SO_INCOMING_CPU = getattr(
+    socket, "SO_INCOMING_CPU", 49 if sys.platform.startswith("linux") else None
+)
+
+_date_cache = (0, b"")
+_thread_buffers = threading.local()
+_small_files: "OrderedDict[Tuple[bytes, int, int], bytes]" = OrderedDict()
+_small_files_lock = threading.Lock()
+_small_files_limit = 1024
+
+
+def http_date() -> bytes:
+    """RFC 1123 date for the Date header, formatted at most once per second"""
+    global _date_cache
+    now = int(time.time())
+    cached_at, value = _date_cache
+    if cached_at != now:
+        value = formatdate(now, usegmt=True).encode("ascii")
+        _date_cache = (now, value)
+    return value
+
+
+@lru_cache(maxsize=1024)
+def guess_content_type(name: bytes) -> Optional[bytes]:
+    """Content-Type for a file name, memoized per name"""
+    # the whole name keeps compound suffixes such as .tar.gz intact
+    content_type, _ = mimetypes.guess_type(os.fsdecode(name))
+    return content_type.encode("ascii") if content_type else None
+
+
+def url_path(url: bytes) -> bytes:
+    """Decoded path of a request target, without query string and fragment"""
+    for delimiter in (b"?", b"#"):
+        end = url.find(delimiter)
+        if end >= 0:
+            url = url[:end]
+    if not url.startswith(b"/"):
+        authority = url.find(b"://")
+        if authority >= 0:
+            # absolute-form target, the path starts after the authority
+            start = url.find(b"/", authority + 3)
+            # an empty path means the root
+            url = url[start:] if start >= 0 else b"/"
+    if b"%" in url:
+        url = unquote_to_bytes(url)
+    return url
+
+
+def read_small_file(fd: int, key: Tuple[bytes, int, int]) -> bytes:
+    """File contents, memoized by (path, mtime_ns, size) until the file changes"""
+    with _small_files_lock:
+        body = _small_files.get(key)
+        if body is not None:
+            _small_files.move_to_end(key)
+            return body
+    size = key[2]
+    # read the descriptor that was fstat'ed, so the bytes match the key
+    body = os.pread(fd, size, 0)
+    if len(body) == size:
+        with _small_files_lock:
+            _small_files[key] = body
+            if len(_small_files) > _small_files_limit:
+                _small_files.popitem(last=False)
+    return body
+
 
 class RequestHandler:
-    _http_protocol = "HTTP/1.0"
-    _server_name = "CustomWebServer"
-    _buffer_size = 1024
-    _base_delimiter = "\r\n"
-    _head_delimiter = "\r\n\r\n"
-    _encoding = "utf8"
-    _index_file = "index.html"
-    _methods = ("GET", "HEAD")
-
-    def __init__(self, client_socket: socket.socket, address: str, document_root: str):
+    _buffer_size = 8192
+    _head_timeout = 5.0
+    # also bounds the reads per call, a fast sender cannot hold the thread
+    _max_head = 4 * _buffer_size
+    _head_delimiter = b"\r\n\r\n"
+    _index_file = b"index.html"
+    _methods = (b"GET", b"HEAD")
+    # larger bodies go out with sendfile(2), which has no copy for
+    # send(MSG_ZEROCOPY) to save; only the rare fallback for file systems
+    # without it copies, in buffer-sized sends that MSG_ZEROCOPY makes
+    # slower, as page pinning and completion notifications cost more
+    # than the copy below about 10 KiB
+    _sendfile_threshold = 10 * 1024
+    _sendfile_unsupported = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+    def __init__(
+        self, client_socket: socket.socket, address: str, document_root: bytes
+    ):
         self._socket = client_socket
         self._address = address
         self._document_root = document_root
-        self._headers = {
-            "Content-Type": "text/html",
-            "Content-Length": "0",
-            "Connection": "close",
-            "Server": self._server_name,
-            "Date": datetime.utcnow().isoformat(),
-        }
-        self.handle()
-
-    def handle(self) -> None:
+        # bytes received past the current request, pipelined by the client
+        self._buffer = bytearray()
+        self._keep_alive = False
+        # whether the client may still send input that will never be read
+        self._unread_input = False
+        # when a request head that started to arrive must be complete
+        self.head_deadline: Optional[float] = None
+        # set once the server has stopped sending and only drains the input
+        self.lingering = False
+
+    def fileno(self) -> int:
+        """Socket descriptor, lets the server watch idle connections"""
+        return self._socket.fileno()
+
+    def close(self) -> None:
+        self._socket.close()
+
+    def handle(self) -> bool:
+        """Serve the requests received so far, returns whether to wait for more"""
         try:
-            request = self._read_request()
-            response_code, method, path = self._parse_request(request)
-            self._send_response(response_code, method, path)
+            while True:
+                request = self._read_request()
+                if request is None:
+                    # the server watches the socket until more data arrives
+                    return True
+                if not request:
+                    break
+                if not self._handle_request(request):
+                    if self._buffer or self._unread_input:
+                        return self.hang_up()
+                    break
         except socket.error as e:
-            logging.info(f"Unable to handle request: {e}")
+            logging.info("Unable to handle request: %s", e)
+        self.close()
+        return False
+
+    def reject(self) -> bool:
+        """Answer 503 and hang up, returns whether the server should drain"""
+        self._keep_alive = False
+        self._send_response(UNAVAILABLE, None, None)
+        return self.hang_up()
+
+    def hang_up(self) -> bool:
+        """Stop sending, returns whether the server should drain the input"""
+        try:
+            # closing with input unread would reset the connection and could
+            # discard the response, so only stop sending and drain until EOF
+            self._socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            self.close()
+            return False
+        self.lingering = True
+        return True
+
+    def drain(self) -> bool:
+        """Discard what the client still sends, returns whether more may follow"""
+        try:
+            return bool(self._socket.recv(self._buffer_size, socket.MSG_DONTWAIT))
+        except BlockingIOError:
+            return True
+        except socket.error:
+            return False
+
+    def _handle_request(self, request: bytearray) -> bool:
+        """Serve one request, returns whether the connection stays open"""
+        fd = None
+        try:
+            response_code, method, fd = self._parse_request(request)
+            self._send_response(response_code, method, fd)
         finally:
-            self._socket.close()
+            if fd is not None:
+                os.close(fd)
+        return self._keep_alive
+
+    def _read_request(self) -> Optional[bytearray]:
+        """Next request head, None while it has not fully arrived"""
+        buffer = self._buffer
+        end = buffer.find(self._head_delimiter)
+        eof = False
+        if end < 0 and len(buffer) <= self._max_head:
+            eof = self._read_head(buffer)
+            end = buffer.find(self._head_delimiter)
+        if end < 0 and not eof and len(buffer) <= self._max_head:
+            if buffer and self.head_deadline is None:
+                # one deadline for the whole head, however slowly it trickles
+                self.head_deadline = time.monotonic() + self._head_timeout
+            return None
+        self.head_deadline = None
+        # a head cut short by EOF or the size limit is still parsed,
+        # it is answered with an error
+        end = end + len(self._head_delimiter) if end >= 0 else len(buffer)
+        request = buffer[:end]
+        del buffer[:end]
+        return request
 
-    def _read_request(self) -> str:
-        buffer = ""
+    def _read_head(self, buffer: bytearray) -> bool:
+        """Buffer what has arrived until a full head is in, True once at EOF"""
+        view = self._thread_buffer()
         while True:
-            val = self._socket.recv(self._buffer_size)
-            if not val:
-                break
-            buffer += val.decode(self._encoding)
+            try:
+                # never wait here, a slow client must not hold the thread
+                size = self._socket.recv_into(view, 0, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return False
+            if not size:
+                return True
+            buffer += view[:size]
             # delimiter can be read only partially
-            if buffer.find(self._head_delimiter) >= 0:
-                break
-        return buffer
+            start = max(len(buffer) - size - len(self._head_delimiter), 0)
+            if buffer.find(self._head_delimiter, start) >= 0:
+                return False
+            if len(buffer) > self._max_head:
+                return False
+
+    def _thread_buffer(self) -> memoryview:
+        """I/O buffer of the current thread, reused across connections"""
+        view = getattr(_thread_buffers, "view", None)
+        if view is None:
+            view = _thread_buffers.view = memoryview(bytearray(self._buffer_size))
+        return view
 
     def _parse_request(
-        self, raw_request: str
-    ) -> Tuple[int, Optional[str], Optional[str]]:
+        self, raw_request: bytearray
+    ) -> Tuple[int, Optional[bytes], Optional[int]]:
+        # malformed or unsupported requests may carry a body we do not read
+        self._keep_alive = False
+        if len(raw_request) > self._max_head:
+            self._unread_input = True
+            return HEAD_TOO_LARGE, None, None
+        # the body is never read, it would be parsed as the next request
+        self._unread_input = BODY_HEADER_RE.search(raw_request) is not None
         try:
-            request = raw_request.split("\r\n")
-            method, url, protocol = request[0].split()
+            request_line = raw_request.split(b"\r\n", 1)[0]
+            method, url, protocol = bytes(request_line).split()
         except ValueError:
             return NOT_ALLOWED, None, None
 
         if method not in self._methods:
             return NOT_ALLOWED, None, None
+        self._keep_alive = not self._unread_input and self._wants_keep_alive(
+            protocol, raw_request
+        )
 
-        router = unquote(urlparse(url).path)
-        if router.endswith("/"):
-            router = os.path.join(router, self._index_file)
-        path = self._document_root + os.path.realpath(router)
-        if not os.path.isfile(path):
-            return NOT_FOUND, method.upper(), path
-
-        content_type, _ = mimetypes.guess_type(path)
-        if content_type:
-            self._set_headers(("Content-Type", content_type))
+        router = url_path(url)
+        if router.endswith(b"/"):
+            router += self._index_file
+        path = os.path.normpath(self._document_root + router.lstrip(b"/"))
+        if not path.startswith(self._document_root):
+            return FORBIDDEN, method, None
         try:
-            size = os.path.getsize(path)
-            self._set_headers(("Content-Length", str(size)))
-        except os.error:
-            return NOT_ALLOWED, None, None
+            # without O_NONBLOCK opening a FIFO waits for a writer,
+            # regular files ignore the flag
+            fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC | os.O_NONBLOCK)
+        except (OSError, ValueError):
+            return NOT_FOUND, method, None
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode):
+            os.close(fd)
+            return NOT_FOUND, method, None
 
-        return OK, method.upper(), path
+        content_type = guess_content_type(os.path.basename(path))
+        self._content_type = content_type or b"text/html"
+        self._content_length = st.st_size
+        self._file_key = (path, st.st_mtime_ns, st.st_size)
 
-    def _set_headers(self, values: Tuple[str, str]) -> None:
-        k, v = values
-        self._headers[k] = v
+        return OK, method, fd
 
-    def _send_response(self, response_code: int, method: str, path: str) -> None:
-        primary_line = (
-            f"{self._http_protocol} {response_code} {CODES_MAPPING[response_code]}"
-        )
-        headers_line = self._base_delimiter.join(
-            f"{k}: {v}" for k, v in self._headers.items()
-        )
-        resp = (
-            f"{primary_line}{self._base_delimiter}{headers_line}{self._head_delimiter}"
-        ).encode(self._encoding)
-        body = None
-        if method == "GET" and response_code == OK:
-            body = self._get_response_body(path)
+    @staticmethod
+    def _wants_keep_alive(protocol: bytes, raw_request: bytearray) -> bool:
+        """HTTP/1.1 connections persist unless closed, HTTP/1.0 ones must opt in"""
+        match = CONNECTION_HEADER_RE.search(raw_request)
+        connection = match.group(1).lower() if match else b""
+        if protocol == b"HTTP/1.1":
+            return b"close" not in connection
+        return b"keep-alive" in connection
+
+    def _send_response(
+        self, response_code: int, method: Optional[bytes], fd: Optional[int]
+    ) -> None:
+        connection = KEEP_ALIVE_HEADER if self._keep_alive else CLOSE_HEADER
+        if response_code != OK:
+            parts = [
+                ERROR_HEADERS[response_code],
+                connection,
+                b"Date: ",
+                http_date(),
+                b"\r\n\r\n",
+            ]
+        else:
+            parts = [
+                OK_HEADERS,
+                connection,
+                b"Date: ",
+                http_date(),
+                b"\r\nContent-Type: ",
+                self._content_type,
+                b"\r\nContent-Length: ",
+                str(self._content_length).encode("ascii"),
+                b"\r\n\r\n",
+            ]
         try:
-            self._socket.sendall(resp + body if body else resp)
+            if method == b"GET" and response_code == OK:
+                self._send_body(parts, fd)
+            else:
+                self._send_parts(parts)
         except socket.error as e:
-            logging.info(f"Unable to send response from socket: {e}")
+            # a send timeout lands here too, the client stopped reading
+            self._keep_alive = False
+            logging.info("Unable to send response from socket: %s", e)
 
-    def _get_response_body(self, path: str = None) -> bytes:
-        body = b""
-        if not path:
-            return body
-        size = int(self._headers["Content-Length"])
-        with open(path, "rb") as f:
-            body = f.read(size)
-        return body
+    def _send_parts(self, parts: List[bytes]) -> None:
+        """Send buffers with a single sendmsg, finishing short writes"""
+        sent = self._socket.sendmsg(parts)
+        if sent < sum(len(part) for part in parts):
+            self._socket.sendall(b"".join(parts)[sent:])
+
+    def _send_body(self, parts: List[bytes], fd: int) -> None:
+        """Send headers and file contents, using sendfile(2) for larger files"""
+        size = self._content_length
+        if size < self._sendfile_threshold:
+            body = read_small_file(fd, self._file_key)
+            self._send_parts(parts + [body])
+            if len(body) < size:
+                self._body_cut_short()
+            return
+        # cork so the headers leave in the same segment as the body start
+        self._set_cork(True)
+        try:
+            self._send_parts(parts)
+            self._sendfile(fd, size)
+        finally:
+            self._set_cork(False)
+
+    def _sendfile(self, fd: int, size: int) -> None:
+        """Copy the file to the socket in kernel space, resuming short writes"""
+        if not hasattr(os, "sendfile"):
+            self._send_copied(fd, size)
+            return
+        out, offset = self._socket.fileno(), 0
+        while offset < size:
+            try:
+                sent = os.sendfile(out, fd, offset, size - offset)
+            except OSError as e:
+                # the file system may not support sendfile(2) at all
+                if offset or e.errno not in self._sendfile_unsupported:
+                    raise
+                self._send_copied(fd, size)
+                return
+            if not sent:
+                self._body_cut_short()
+                break
+            offset += sent
+
+    def _send_copied(self, fd: int, size: int) -> None:
+        """Send the file through the thread's buffer, when sendfile(2) cannot"""
+        # unlike a mapping, reading past a new end of file cannot fault
+        view = self._thread_buffer()
+        offset = 0
+        while offset < size:
+            read = os.preadv(fd, [view[: size - offset]], offset)
+            if not read:
+                break
+            self._socket.sendall(view[:read])
+            offset += read
+        if offset < size:
+            self._body_cut_short()
+
+    def _body_cut_short(self) -> None:
+        """The file shrank while it was sent"""
+        # the headers promised more, only closing tells the client
+        self._keep_alive = False
+
+    def _set_cork(self, enabled: bool) -> None:
+        if hasattr(socket, "TCP_CORK"):
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, enabled)
 
 
 class WebServer:
-    def __init__(self, host: str, port: int) -> None:
+    # queued connections already have a request waiting, so this bounds how
+    # far a worker falls behind: 16 small responses are a few milliseconds of
+    # work, a queue longer than that is sustained overload, not a burst
+    _pending_per_thread = 16
+    _idle_timeout = 5.0
+    # struct timeval for SO_SNDTIMEO, seconds and microseconds
+    _send_timeout = struct.pack("ll", 5, 0)
+    _accept_backoff = 0.5
+    # errors of the connection being accepted, not of the listener
+    _accept_transient = (
+        errno.ECONNABORTED,
+        errno.EPROTO,
+        errno.EPERM,
+        errno.ENETDOWN,
+        errno.ENETUNREACH,
+        errno.EHOSTDOWN,
+        errno.EHOSTUNREACH,
+        errno.ENOPROTOOPT,
+        errno.EOPNOTSUPP,
+    )
+
+    def __init__(
+        self, host: str, port: int, threads: int, cpu: Optional[int] = None
+    ) -> None:
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._cpu = cpu
+        if cpu is not None and SO_INCOMING_CPU is not None:
+            # SO_REUSEPORT prefers the listener whose CPU received the packet
+            self._socket.setsockopt(socket.SOL_SOCKET, SO_INCOMING_CPU, cpu)
         self._bind_server(host, port, reuse_address=True, reuse_port=True)
-        self._activate_server(request_queue_size=5)
+        self._activate_server(request_queue_size=socket.SOMAXCONN)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._socket, selectors.EVENT_READ)
+        self._threads = threads
+        # connections with data to read, consumed by the worker threads
+        self._queue = queue.SimpleQueue()
+        # persistent connections handed back by the worker threads, the
+        # socket pair wakes the selector up to start watching them
+        self._parked = queue.SimpleQueue()
+        self._waker, self._wakeup = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wakeup.setblocking(False)
+        self._selector.register(self._waker, selectors.EVENT_READ)
+        # watched connections and their deadlines, with a heap of the latter;
+        # heap entries whose deadline no longer matches are stale
+        self._idle: Dict[RequestHandler, float] = {}
+        self._deadlines: List[Tuple[float, int, RequestHandler]] = []
+        self._deadline_order = itertools.count()
+        # set while the listener is out of the selector after accept errors
+        self._accept_paused_until: Optional[float] = None
+        self._accept_failing = False
 
     def _bind_server(
         self, host: str, port: int, reuse_address: bool, reuse_port: bool
@@ -150,42 +486,206 @@ class WebServer:
     def _activate_server(self, request_queue_size: int) -> None:
         """Called by init to activate the server"""
         self._socket.listen(request_queue_size)
+        self._socket.setblocking(False)
 
     def close(self) -> None:
         """Clean up the server"""
+        for handler in self._idle:
+            handler.close()
+        self._idle.clear()
+        self._deadlines.clear()
+        self._selector.close()
+        self._waker.close()
+        self._wakeup.close()
         self._socket.close()
 
     def serve_forever(
-        self, request_handler: RequestHandler, document_root: str, threads: int
+        self, request_handler: RequestHandler, document_root: bytes
+    ) -> None:
+        if self._cpu is not None:
+            # pin before starting threads so that they inherit the affinity
+            os.sched_setaffinity(0, {self._cpu})
+        # threads are started here, they would not survive the worker fork
+        for _ in range(self._threads):
+            threading.Thread(target=self._process_queue, daemon=True).start()
+        try:
+            while True:
+                try:
+                    for key, _ in self._selector.select(self._select_timeout()):
+                        try:
+                            self._handle_event(key, request_handler, document_root)
+                        except socket.error as e:
+                            # keep listening, the error only affects this event
+                            logging.info("Unable to handle socket event: %s", e)
+                finally:
+                    # idle connections are what frees descriptors, always sweep
+                    self._close_idle()
+                    self._resume_accepting()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def _handle_event(
+        self,
+        key: selectors.SelectorKey,
+        request_handler: RequestHandler,
+        document_root: bytes,
     ) -> None:
+        if key.fileobj is self._socket:
+            self._accept_pending(request_handler, document_root)
+        elif key.fileobj is self._waker:
+            self._watch_parked()
+        elif key.fileobj.lingering:
+            self._drain(key.fileobj)
+        else:
+            self._dispatch(key.fileobj)
+
+    def _process_queue(self) -> None:
+        """Handle queued connections, run by each worker thread"""
+        while True:
+            handler = self._queue.get()
+            try:
+                keep_alive = handler.handle()
+            except Exception:
+                logging.exception("Unable to handle request")
+                handler.close()
+                continue
+            if keep_alive:
+                self._park(handler)
+
+    def _park(self, handler: RequestHandler) -> None:
+        """Hand a persistent connection back to the selector loop"""
+        self._parked.put(handler)
+        try:
+            self._wakeup.send(b"\0")
+        except BlockingIOError:
+            # the loop has wakeups pending already
+            pass
+
+    def _watch_parked(self) -> None:
+        try:
+            self._waker.recv(self._threads * self._pending_per_thread)
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                handler = self._parked.get_nowait()
+            except queue.Empty:
+                return
+            if handler.lingering:
+                self._linger(handler)
+            else:
+                self._watch(handler)
+
+    def _watch(self, handler: RequestHandler) -> None:
+        """Wait in the selector until the client sends more of its request"""
+        deadline = handler.head_deadline or time.monotonic() + self._idle_timeout
+        self._selector.register(handler, selectors.EVENT_READ)
+        self._expire_at(handler, deadline)
+
+    def _linger(self, handler: RequestHandler) -> None:
+        """Drain a connection that was hung up on until the client closes it"""
+        self._selector.register(handler, selectors.EVENT_READ)
+        self._expire_at(handler, time.monotonic() + self._idle_timeout)
+
+    def _expire_at(self, handler: RequestHandler, deadline: float) -> None:
+        self._idle[handler] = deadline
+        heapq.heappush(self._deadlines, (deadline, next(self._deadline_order), handler))
+
+    def _unwatch(self, handler: RequestHandler) -> None:
+        self._selector.unregister(handler)
+        del self._idle[handler]
+
+    def _dispatch(self, handler: RequestHandler) -> None:
+        self._unwatch(handler)
+        self._queue.put(handler)
+
+    def _close_idle(self) -> None:
+        """Drop connections that stayed idle past their deadline"""
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, _, handler = heapq.heappop(self._deadlines)
+            if self._idle.get(handler) != deadline:
+                continue
+            self._unwatch(handler)
+            handler.close()
+
+    def _accept_pending(
+        self, request_handler: RequestHandler, document_root: bytes
+    ) -> None:
+        """Drain the listen backlog and watch each connection for its request"""
         while True:
             try:
                 client_socket, address = self._socket.accept()
-                with ThreadPoolExecutor(max_workers=threads) as ex:
-                    futures = [
-                        ex.submit(
-                            request_handler, client_socket, address, document_root
-                        )
-                    ]
-                    for f in as_completed(futures):
-                        f.result()
-            except socket.error as e:
-                logging.info(f"Unable to accept socket connection: {e}")
-                self.close()
+            except BlockingIOError:
+                return
+            except OSError as e:
+                if e.errno in self._accept_transient:
+                    # only this client is affected, try the next one
+                    continue
+                # e.g. EMFILE, leave the rest queued until descriptors are freed
+                self._pause_accepting(e)
+                return
+            self._accept_failing = False
+            handler = request_handler(client_socket, address, document_root)
+            if self._queue.qsize() >= self._threads * self._pending_per_thread:
+                # the socket is still non-blocking, answering cannot stall
+                if handler.reject():
+                    self._linger(handler)
+                continue
+            # handlers do blocking I/O in worker threads, SO_SNDTIMEO makes
+            # sends to a client that stopped reading fail instead of hanging
+            client_socket.setblocking(True)
+            client_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDTIMEO, self._send_timeout
+            )
+            self._watch(handler)
+
+    def _pause_accepting(self, error: OSError) -> None:
+        """Stop watching the listener for a while, it stays readable"""
+        if not self._accept_failing:
+            # logged once per failure streak, retries would flood the log
+            logging.info("Unable to accept socket connection: %s", error)
+            self._accept_failing = True
+        self._selector.unregister(self._socket)
+        self._accept_paused_until = time.monotonic() + self._accept_backoff
+
+    def _resume_accepting(self) -> None:
+        if self._accept_paused_until is None:
+            return
+        if time.monotonic() >= self._accept_paused_until:
+            self._selector.register(self._socket, selectors.EVENT_READ)
+            self._accept_paused_until = None
+
+    def _select_timeout(self) -> float:
+        if self._accept_paused_until is None:
+            return 1.0
+        return max(self._accept_paused_until - time.monotonic(), 0.0)
+
+    def _drain(self, handler: RequestHandler) -> None:
+        if not handler.drain():
+            self._unwatch(handler)
+            handler.close()
 
 
 def main(host: str, port: int, workers: int, threads: int, document_root: str) -> None:
     processes = []
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    # resolved once to a bytes prefix ending in a separator,
+    # request paths are appended to it and checked against it lexically
+    root = os.path.join(os.fsencode(os.path.realpath(document_root)), b"")
     try:
-        for _ in range(workers):
-            server = WebServer(host, port)
+        for worker in range(workers):
+            cpu = cpus[worker % len(cpus)] if cpus else None
+            server = WebServer(host, port, threads, cpu)
             process = multiprocessing.Process(
                 target=server.serve_forever,
-                args=(RequestHandler, document_root, threads),
+                args=(RequestHandler, root),
             )
             processes.append(process)
             process.start()
-            logging.info(f"Started server on {host}:{port}")
+            logging.info("Started server on %s:%s", host, port)
         for process in processes:
             process.join()
     except KeyboardInterrupt:
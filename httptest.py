@@ -9,6 +9,7 @@ import socket
 
 if v3:
     import http.client as httplib
+    from email.utils import parsedate_to_datetime
 else:
     import httplib
 import unittest
@@ -42,6 +43,16 @@ class HttpServer(unittest.TestCase):
         server = r.getheader("Server")
         self.assertIsNotNone(server)
 
+    def test_date_header(self):
+        """Date header in RFC 1123 format"""
+        self.conn.request("GET", "/httptest/text..txt")
+        r = self.conn.getresponse()
+        data = r.read()
+        date = r.getheader("Date")
+        self.assertTrue(date.endswith(" GMT"))
+        if v3:
+            self.assertIsNotNone(parsedate_to_datetime(date))
+
     def test_directory_index(self):
         """directory index file exists"""
         self.conn.request("GET", "/httptest/dir2/")
@@ -228,6 +239,91 @@ class HttpServer(unittest.TestCase):
         else:
             self.assertIn(int(code), (400, 405))
 
+    def recv_until_closed(self, s):
+        s.settimeout(10)
+        data = b""
+        while 1:
+            buf = s.recv(1024)
+            if not buf:
+                break
+            data += buf
+        s.close()
+        return data
+
+    def test_keep_alive(self):
+        """connection reused for HTTP/1.1"""
+        self.conn.request("GET", "/httptest/text..txt")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(r.version, 11)
+        self.assertEqual(r.getheader("Connection"), "keep-alive")
+        self.conn.request("GET", "/httptest/dir2/page.html")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(len(data), 38)
+
+    def test_pipelined_requests(self):
+        """pipelined requests answered in order"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((self.host, self.port))
+        s.sendall(
+            b"GET /httptest/text..txt HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /httptest/dir2/page.html HTTP/1.1\r\nHost: localhost\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        data = self.recv_until_closed(s)
+        responses = data.split(b"HTTP/1.1 200 OK\r\n")
+        self.assertEqual(len(responses), 3)
+        self.assertTrue(responses[1].endswith(b"\r\n\r\nhello"))
+        self.assertIn(b"Connection: keep-alive\r\n", responses[1])
+        self.assertTrue(
+            responses[2].endswith(b"<html><body>Page Sample</body></html>\n")
+        )
+        self.assertIn(b"Connection: close\r\n", responses[2])
+
+    def test_http10_closes(self):
+        """HTTP/1.0 without keep-alive closes after the response"""
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((self.host, self.port))
+        s.sendall(b"GET /httptest/text..txt HTTP/1.0\r\n\r\n")
+        data = self.recv_until_closed(s)
+        self.assertTrue(data.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b"Connection: close\r\n", data)
+        self.assertTrue(data.endswith(b"\r\n\r\nhello"))
+
+    def test_request_with_body_closes(self):
+        """request with a body closes the connection"""
+        self.conn.request("GET", "/httptest/text..txt", body="unread")
+        r = self.conn.getresponse()
+        data = r.read()
+        self.assertEqual(int(r.status), 200)
+        self.assertEqual(r.getheader("Connection"), "close")
+
+    def send_raw(self, request):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((self.host, self.port))
+        s.sendall(request)
+        return self.recv_until_closed(s)
+
+    def test_absolute_form(self):
+        """absolute-form request target"""
+        data = self.send_raw(
+            b"GET http://localhost/httptest/text..txt HTTP/1.0\r\n\r\n"
+        )
+        self.assertTrue(data.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertTrue(data.endswith(b"\r\n\r\nhello"))
+
+    def test_absolute_form_without_path(self):
+        """absolute-form request target without a path"""
+        data = self.send_raw(b"GET http://localhost HTTP/1.0\r\n\r\n")
+        self.assertTrue(re.match(b"HTTP/1\\.1 (200|404) [^\r\n]+\r\n", data))
+
+    def test_absolute_form_non_ascii(self):
+        """absolute-form request target with a non-ASCII byte"""
+        data = self.send_raw(b"GET http://localhost/\xff HTTP/1.0\r\n\r\n")
+        self.assertTrue(data.startswith(b"HTTP/1.1 404 Not Found\r\n"))
+
     def test_filetype_html(self):
         """Content-Type for .html"""
         self.conn.request("GET", "/httptest/dir2/page.html")